@@ -2,19 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import copy
 import json
 import os
-from typing import List, Optional, Dict, Any
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Dict, Any, Callable, Iterable, Tuple
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
 # python-OBD
 import obd
+import orjson
 
-app = FastAPI(title="Launch-like OBD Web")
+app = FastAPI(title="Launch-like OBD Web", default_response_class=ORJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=512)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # ---------- Estado de conexión global ----------
@@ -23,6 +30,11 @@ class OBDState:
         self.connection: Optional[obd.OBD] = None
         self.port: Optional[str] = None
         self.protocol: Optional[str] = None
+        # El ELM327 atiende una petición a la vez; serializa el acceso al puerto.
+        self.lock = threading.Lock()
+        # Se desactiva si el adaptador/protocolo no responde a peticiones multi-PID.
+        self.multi_pid = True
+        self.multi_pid_failures = 0
 
 state = OBDState()
 
@@ -44,15 +56,242 @@ SUPPORTED_PIDS = {
 }
 
 def ensure_connected() -> bool:
-    return state.connection is not None and state.connection.status() == obd.OBDStatus.CAR_CONNECTED
+    conn = state.connection  # lectura única: close_connection() puede anularla en otro hilo
+    return conn is not None and conn.status() == obd.OBDStatus.CAR_CONNECTED
 
-def result_to_primitive(r: obd.OBDResponse) -> Any:
-    if r is None or r.value is None:
-        return None
-    try:
-        return getattr(r.value, "magnitude", str(r.value))
-    except Exception:
-        return str(r.value)
+def query(cmd: obd.OBDCommand, force: bool = False) -> obd.OBDResponse:
+    with state.lock:
+        return state.connection.query(cmd, force=force)
+
+def close_connection() -> None:
+    with state.lock:
+        if state.connection is not None:
+            try:
+                state.connection.close()
+            except Exception:
+                pass
+        state.connection = None
+
+def _make_decoder(cmd: obd.OBDCommand) -> Callable[[obd.OBDResponse], Any]:
+    # STATUS devuelve un objeto Status; el resto de SUPPORTED_PIDS son magnitudes de Pint.
+    if cmd.decode is obd.decoders.status:
+        return lambda r: None if r is None or r.value is None else str(r.value)
+    return lambda r: None if r is None or r.value is None else r.value.magnitude
+
+_DECODERS: Dict[str, Callable[[obd.OBDResponse], Any]] = {
+    name: _make_decoder(cmd) for name, cmd in SUPPORTED_PIDS.items()
+}
+
+# ---------- Consultas multi-PID (modo 01) ----------
+MAX_PIDS_PER_REQUEST = 6  # límite de OBD-II para una petición modo 01
+MULTI_PID_MAX_FAILURES = 3  # respuestas vacías seguidas antes de desactivar multi-PID
+
+def _is_mode01(cmd: obd.OBDCommand) -> bool:
+    return len(cmd.command) == 4 and cmd.command[:2] == b"01"
+
+def _multi_pid_command(cmds: List[obd.OBDCommand]) -> obd.OBDCommand:
+    raw = b"01" + b"".join(c.command[2:] for c in cmds)
+    # fast=True: en modo rápido el ELM327 recibe el nº de tramas esperado y no espera al timeout.
+    return obd.OBDCommand("MULTI_PID", "Mode 01 multi-PID", raw, 0, obd.decoders.raw_string,
+                          ecu=obd.ECU.ENGINE, fast=True)
+
+def _split_multi_pid(resp: obd.OBDResponse, cmds: List[obd.OBDCommand]) -> Dict[str, obd.OBDResponse]:
+    """Separa la respuesta '41 PID datos PID datos ...' en respuestas por comando."""
+    by_pid = {int(c.command[2:], 16): c for c in cmds}
+    out: Dict[str, obd.OBDResponse] = {}
+    for msg in resp.messages:
+        data = msg.data
+        if not data or data[0] != 0x41:
+            continue
+        i = 1
+        while i < len(data):
+            cmd = by_pid.get(data[i])
+            if cmd is None:
+                break
+            n = cmd.bytes - 2
+            if i + 1 + n > len(data):
+                break  # respuesta truncada: mejor consultar el PID por separado
+            # Varias ECUs (p. ej. motor y transmisión) pueden responder al mismo PID.
+            if cmd.ecu & msg.ecu:
+                part = copy.copy(msg)
+                part.data = bytearray([0x41, data[i]]) + data[i + 1:i + 1 + n]
+                r = cmd([part])
+                if r.value is not None:
+                    out.setdefault(cmd.name, r)
+            i += 1 + n
+    return out
+
+# ---------- Caché de lecturas por PID ----------
+PID_CACHE_TTL = 0.1  # segundos; absorbe sondeos duplicados (varias pestañas, REST + WS)
+_PID_CACHE: Dict[str, Tuple[float, Any]] = {}
+_PID_CACHE_LOCK = threading.Lock()
+
+def _cache_get(names: Iterable[str], ttl: float = PID_CACHE_TTL) -> Dict[str, Any]:
+    now = time.monotonic()
+    with _PID_CACHE_LOCK:
+        hits = {}
+        for n in names:
+            entry = _PID_CACHE.get(n)
+            if entry is not None and now - entry[0] < ttl:
+                hits[n] = entry[1]
+        return hits
+
+def _cache_put(values: Dict[str, Any], ts: float) -> None:
+    # ts es el instante en que se envió la consulta, no cuando terminó.
+    with _PID_CACHE_LOCK:
+        for n, v in values.items():
+            _PID_CACHE[n] = (ts, v)
+
+def _cache_clear() -> None:
+    with _PID_CACHE_LOCK:
+        _PID_CACHE.clear()
+
+def batch_query(names: List[str], use_cache: bool = True) -> Dict[str, Any]:
+    """Lee varios PIDs agrupando los de modo 01 en peticiones de hasta 6 PIDs."""
+    out: Dict[str, Any] = {n: None for n in names}
+    cached = _cache_get(n for n in out if n in SUPPORTED_PIDS) if use_cache else {}
+    out.update(cached)
+    cmds = {n: SUPPORTED_PIDS[n] for n in out if n in SUPPORTED_PIDS and n not in cached}
+    started = time.monotonic()
+    conn = state.connection
+    batchable = [
+        n for n, c in cmds.items() if _is_mode01(c) and conn is not None and conn.supports(c)
+    ] if state.multi_pid else []
+    single = [n for n in cmds if n not in batchable]
+
+    for i in range(0, len(batchable), MAX_PIDS_PER_REQUEST):
+        group = batchable[i:i + MAX_PIDS_PER_REQUEST]
+        if len(group) == 1:
+            single.extend(group)
+            continue
+        group_cmds = [cmds[n] for n in group]
+        parts = _split_multi_pid(query(_multi_pid_command(group_cmds), force=True), group_cmds)
+        if parts:
+            state.multi_pid_failures = 0
+        else:
+            state.multi_pid_failures += 1
+            if state.multi_pid_failures >= MULTI_PID_MAX_FAILURES:
+                state.multi_pid = False
+        for n in group:
+            r = parts.get(cmds[n].name)
+            if r is None:
+                single.append(n)
+            else:
+                out[n] = _DECODERS[n](r)
+
+    for n in single:
+        out[n] = _DECODERS[n](query(cmds[n]))
+    _cache_put({n: out[n] for n in cmds}, started)
+    return out
+
+# ---------- Sondeo en segundo plano para /ws/live ----------
+class LiveSubscriber:
+    def __init__(self, loop: asyncio.AbstractEventLoop, pids: List[str], interval: float):
+        self.loop = loop
+        self.pids = pids
+        self.interval = interval
+        # Solo interesa la última lectura: un cliente lento recibe la más reciente.
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.dropped = False
+        self.next_due = 0.0
+
+    def publish(self, msg: Dict[str, Any]) -> None:
+        # Llamado desde el hilo de sondeo.
+        try:
+            self.loop.call_soon_threadsafe(self._put_latest, msg)
+        except RuntimeError:
+            pass  # el event loop ya se cerró
+
+    def _put_latest(self, msg: Dict[str, Any]) -> None:
+        if self.queue.full():
+            pending = self.queue.get_nowait()
+            if pending["type"] == "error":
+                self.queue.put_nowait(pending)
+                return
+            self.dropped = True
+        self.queue.put_nowait(msg)
+
+    async def get(self) -> Dict[str, Any]:
+        msg = await self.queue.get()
+        if self.dropped and msg["type"] == "live":
+            msg = {**msg, "$backpressure": True}
+            self.dropped = False
+        return msg
+
+class LivePoller:
+    """Un único hilo lee el ELM327 y reparte las lecturas a todos los clientes WebSocket."""
+
+    def __init__(self):
+        self._subs: List[LiveSubscriber] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, pids: List[str], interval: float) -> LiveSubscriber:
+        sub = LiveSubscriber(asyncio.get_running_loop(), pids, interval)
+        with self._lock:
+            self._subs.append(sub)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="obd-live-poller", daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub: LiveSubscriber) -> None:
+        with self._lock:
+            if sub in self._subs:
+                self._subs.remove(sub)
+
+    def _run(self) -> None:
+        try:
+            while True:
+                try:
+                    if not self._tick():
+                        return
+                except Exception as e:
+                    # Un fallo inesperado no debe dejar a los clientes esperando para siempre.
+                    self._fail_all(str(e))
+        finally:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _fail_all(self, error: str) -> None:
+        with self._lock:
+            subs, self._subs = self._subs, []
+        for s in subs:
+            s.publish({"type": "error", "msg": error})
+
+    def _tick(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if not self._subs:
+                self._thread = None
+                return False
+            due = [s for s in self._subs if s.next_due <= now]
+
+        if due:
+            if not ensure_connected():
+                for s in due:
+                    s.publish({"type": "error", "msg": "Conexión perdida"})
+                    self.unsubscribe(s)
+            else:
+                pids = list(dict.fromkeys(p for s in due for p in s.pids))
+                try:
+                    # El hilo ya agrupa a todos los clientes WS; lee siempre fresco.
+                    data = batch_query(pids, use_cache=False)
+                    msg = None
+                except Exception as e:
+                    data = {}
+                    msg = {"type": "error", "msg": str(e)}
+                for s in due:
+                    s.next_due = now + s.interval
+                    s.publish(msg or {"type": "live", "data": {p: data[p] for p in s.pids}})
+
+        with self._lock:
+            wake = min((s.next_due for s in self._subs), default=now)
+        time.sleep(min(max(0.0, wake - time.monotonic()), 0.1))
+        return True
+
+poller = LivePoller()
 
 # ---------- Modelos ----------
 class ConnectPayload(BaseModel):
@@ -65,10 +304,11 @@ class LiveQuery(BaseModel):
     interval_ms: int = 500
 
 # ---------- Rutas API ----------
+INDEX_HTML = Path("static", "index.html").read_bytes()
+
 @app.get("/", response_class=HTMLResponse)
 def root():
-    with open(os.path.join("static", "index.html"), "r", encoding="utf-8") as f:
-        return HTMLResponse(f.read())
+    return HTMLResponse(INDEX_HTML)
 
 @app.get("/api/ports")
 def list_ports():
@@ -76,13 +316,8 @@ def list_ports():
     return {"ok": True, "ports": ports}
 
 @app.post("/api/connect")
-def connect(payload: ConnectPayload):
-    if state.connection is not None:
-        try:
-            state.connection.close()
-        except Exception:
-            pass
-        state.connection = None
+async def connect(payload: ConnectPayload):
+    await asyncio.to_thread(close_connection)
 
     kwargs = {}
     if payload.port:
@@ -92,26 +327,26 @@ def connect(payload: ConnectPayload):
     if payload.baudrate:
         kwargs["baudrate"] = payload.baudrate
 
-    conn = obd.OBD(**kwargs)
+    # El autodetect del ELM327 tarda segundos; no bloquear el event loop.
+    conn = await asyncio.to_thread(obd.OBD, **kwargs)
     if conn.status() in (obd.OBDStatus.NOT_CONNECTED, obd.OBDStatus.ELM_CONNECTED):
-        return JSONResponse({"ok": False, "status": str(conn.status())}, status_code=400)
+        return ORJSONResponse({"ok": False, "status": str(conn.status())}, status_code=400)
 
     state.connection = conn
+    state.multi_pid = True
+    state.multi_pid_failures = 0
+    _cache_clear()
     state.port = conn.port_name()
     state.protocol = str(conn.protocol_name()) if conn.protocol_name() else None
 
     return {"ok": True, "status": str(conn.status()), "port": state.port, "protocol": state.protocol}
 
 @app.post("/api/disconnect")
-def disconnect():
-    if state.connection:
-        try:
-            state.connection.close()
-        except Exception:
-            pass
-    state.connection = None
+async def disconnect():
+    await asyncio.to_thread(close_connection)
     state.port = None
     state.protocol = None
+    _cache_clear()
     return {"ok": True}
 
 @app.get("/api/status")
@@ -122,16 +357,16 @@ def status():
 @app.get("/api/vin")
 def read_vin():
     if not ensure_connected():
-        return JSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
-    r = state.connection.query(obd.commands.GET_VIN)
+        return ORJSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
+    r = query(obd.commands.GET_VIN)
     vin = str(r.value) if r.value else None
     return {"ok": True, "vin": vin}
 
 @app.get("/api/dtc")
 def read_dtc():
     if not ensure_connected():
-        return JSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
-    r = state.connection.query(obd.commands.GET_DTC)
+        return ORJSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
+    r = query(obd.commands.GET_DTC)
     codes = r.value if r and r.value else []
     parsed = []
     for item in codes:
@@ -146,8 +381,8 @@ def read_dtc():
 @app.delete("/api/dtc")
 def clear_dtc():
     if not ensure_connected():
-        return JSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
-    r = state.connection.query(obd.commands.CLEAR_DTC)
+        return ORJSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
+    r = query(obd.commands.CLEAR_DTC)
     return {"ok": True, "cleared": True, "raw": str(r.value) if r else None}
 
 @app.get("/api/pids")
@@ -157,23 +392,15 @@ def list_pids():
 @app.get("/api/live")
 def live_snapshot(names: str = Query(default="RPM,SPEED,COOLANT_TEMP")):
     if not ensure_connected():
-        return JSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
+        return ORJSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
     wanted = [n.strip().upper() for n in names.split(",") if n.strip()]
-    out: Dict[str, Any] = {}
-    for n in wanted:
-        cmd = SUPPORTED_PIDS.get(n)
-        if not cmd:
-            out[n] = None
-            continue
-        resp = state.connection.query(cmd)
-        out[n] = result_to_primitive(resp)
-    return {"ok": True, "data": out}
+    return {"ok": True, "data": batch_query(wanted)}
 
 @app.get("/api/monitors")
 def monitors():
     if not ensure_connected():
-        return JSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
-    resp = state.connection.query(obd.commands.STATUS)
+        return ORJSONResponse({"ok": False, "error": "No conectado"}, status_code=400)
+    resp = query(obd.commands.STATUS)
     data = str(resp.value) if resp and resp.value else ""
     return {"ok": True, "status_text": data}
 
@@ -182,7 +409,7 @@ def monitors():
 async def ws_live(ws: WebSocket):
     await ws.accept()
     if not ensure_connected():
-        await ws.send_text(json.dumps({"type": "error", "msg": "No conectado"}))
+        await ws.send_bytes(orjson.dumps({"type": "error", "msg": "No conectado"}))
         await ws.close()
         return
 
@@ -195,30 +422,37 @@ async def ws_live(ws: WebSocket):
         pid_names = ["RPM", "SPEED"]
         interval_ms = 500
 
+    sub = poller.subscribe(pid_names, max(0.1, interval_ms / 1000))
     try:
         while True:
-            if not ensure_connected():
-                await ws.send_text(json.dumps({"type": "error", "msg": "Conexión perdida"}))
+            msg = await sub.get()
+            await ws.send_bytes(orjson.dumps(msg))
+            if msg["type"] == "error":
                 await ws.close()
                 break
-            payload = {}
-            for n in pid_names:
-                cmd = SUPPORTED_PIDS.get(n)
-                if not cmd:
-                    payload[n] = None
-                    continue
-                r = state.connection.query(cmd)
-                payload[n] = result_to_primitive(r)
-            await ws.send_text(json.dumps({"type": "live", "data": payload}))
-            await asyncio.sleep(max(0.1, interval_ms / 1000))
     except WebSocketDisconnect:
         pass
     except Exception as e:
         try:
-            await ws.send_text(json.dumps({"type": "error", "msg": str(e)}))
+            await ws.send_bytes(orjson.dumps({"type": "error", "msg": str(e)}))
         except Exception:
             pass
         try:
             await ws.close()
         except Exception:
             pass
+    finally:
+        poller.unsubscribe(sub)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Un solo worker: la conexión serie vive en este proceso. loop/http quedan en "auto",
+    # que usa uvloop + httptools si están instalados (uvloop no existe en Windows).
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        ws="websockets",
+        workers=1,
+    )